@@ -28,11 +28,22 @@
 """
 
 #Standard library imports:
-from os import getcwd, makedirs, sep, walk
-from os.path import isdir, isfile, getsize, join as path_join
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
+from os import chmod, cpu_count, getcwd, makedirs, scandir, sep, stat, stat_result, utime
+from os.path import expanduser, isdir, isfile, join as path_join, realpath
 from pathlib import Path
+from re import compile as re_compile, DOTALL
 from shutil import copy2
-from subprocess import Popen, PIPE
+from stat import S_IMODE
+from subprocess import run, PIPE
+import sys
+
+#copy_file_range, posix_fallocate and sendfile are only available on Linux (copy_file_range needs Python 3.8 or newer). Without them, we'll just copy files with shutil.copy2 instead:
+try:
+    from os import copy_file_range, posix_fallocate, sendfile
+except ImportError:
+    copy_file_range = None
 
 
 
@@ -73,6 +84,22 @@ def main():
 
 
 
+#Cached versions of isfile and isdir for probing the possible Steam and TF2 paths.
+#Nothing is installed or removed while we're searching, so there's no need to ask the file system about the same path twice.
+#These must only be used for the search. The copy step changes the file system, so a cached result could be stale there.
+
+@lru_cache(maxsize=64)
+def isfile_cached(path: str) -> bool:
+    """Returns whether the given path is a file, caching the result."""
+    return isfile(path)
+
+@lru_cache(maxsize=64)
+def isdir_cached(path: str) -> bool:
+    """Returns whether the given path is a directory, caching the result."""
+    return isdir(path)
+
+
+
 #Locates where Steam is installed on this computer.
 #We will search for the Steam installation on the file system. Failing that, we'll search for where the currently-running Steam application was launched from.
 
@@ -84,18 +111,24 @@ def locate_steam_dir() -> str:
     #~/.steam/steam
     #~/.local/share/Steam/
     #
-    #We will poke at both directories to find the /steamapps/libraryfolder.vdf file:
-    home_dir = str(Path.home())
+    #On most systems ~/.steam/steam is just a symlink to ~/.local/share/Steam/, so we resolve both paths first and only check each real directory once.
+    #We will poke at these directories to find the /steamapps/libraryfolder.vdf file:
     libraryfolders_path = "/steamapps/libraryfolders.vdf"
-    for x in ("/.steam/steam", "/.local/share/Steam/"):
-        library_vdf = home_dir + x + libraryfolders_path
-        if isfile(library_vdf):
+    steam_dirs = dict.fromkeys(realpath(expanduser(x)) for x in ("~/.steam/steam", "~/.local/share/Steam/"))      #A dict keeps the search order, unlike a set
+    for x in steam_dirs:
+        library_vdf = x + libraryfolders_path
+        if isfile_cached(library_vdf):
             return library_vdf
 
     #If neither directory contains the libraryfolders.vdf file, then we'll check the Steam process to see which directory it was launched from.
     #Note that this section only applies if Steam is actively running on this computer. It will NOT work if Steam is not running!
-    p = Popen("ps -aux | grep steam.sh", shell=True, stdout=PIPE)
-    for x in p.stdout.read().decode().split("\n"):
+    #pgrep lists the matching processes and their command lines directly, so we don't need to spawn a shell to pipe ps into grep.
+    #run waits for pgrep to exit, so the child process is reaped and its pipe is closed:
+    try:
+        pgrep_output = run(["pgrep", "-af", "steam.sh"], stdout=PIPE).stdout
+    except FileNotFoundError:
+        return None
+    for x in pgrep_output.decode().split("\n"):
 
         #Skip blank lines:
         if not x.strip():
@@ -110,7 +143,7 @@ def locate_steam_dir() -> str:
             #Extract the Steam directory path and check if it contains the libraryfolders.vdf file. If so, then we're done:
             steam_dir = str(Path(split_str[-1]).parent)
             library_vdf = steam_dir + libraryfolders_path
-            if isfile(library_vdf):
+            if isfile_cached(library_vdf):
                 return library_vdf
 
     #If we weren't able to locate the Steam directory, then abort.
@@ -120,27 +153,37 @@ def locate_steam_dir() -> str:
 
 #Locates where TF2 is installed on this computer.
 #We will search for the TF2 installation using the libraryfolders.vdf file.
+#We only need each library's path and the IDs in its apps block, so we pull those straight out of the file with regexes instead of parsing the whole KeyValues tree.
+
+#Matches a library's "path" value and the contents of the "apps" block that follows it, without running on into the next library:
+library_folder_regex = re_compile(r'"path"\s+"((?:[^"\\]|\\.)*)"(?:(?!"path").)*?"apps"\s*\{([^}]*)\}', DOTALL)
+
+#Matches each "key" "value" pair inside an apps block. The key is captured so that we don't mistake a value for an app ID:
+app_entry_regex = re_compile(r'"((?:[^"\\]|\\.)*)"\s+"(?:[^"\\]|\\.)*"')
+
+#Matches a backslash escape inside a VDF string:
+escape_regex = re_compile(r"\\(.)")
 
 def locate_tf2_dir(vdf_file: str) -> str:
     """Searches for the directory where TF2 is installed."""
 
-    #Load the libraryfolders.vdf file and grab the main tree:
-    kv = KeyValues(filename=vdf_file)
-    root = kv["libraryfolders"]
+    #Load the libraryfolders.vdf file:
+    with open(vdf_file, mode="r", encoding="utf-8") as f:
+        data = f.read()
 
     #Loop each Steam library folder:
-    for x in root.values():
+    for x in library_folder_regex.finditer(data):
 
-        #Grab its path string and apps tree:
-        path = x["path"]
-        apps_tree = x["apps"]
+        #Grab its path string (undoing the VDF backslash escapes) and apps block:
+        path = escape_regex.sub(r"\1", x.group(1))
+        apps_block = x.group(2)
 
-        #If app 440 (TF2) is present in the apps tree, then this is the library path where TF2 should be installed at:
-        if "440" in apps_tree:
+        #If app 440 (TF2) is present in the apps block, then this is the library path where TF2 should be installed at:
+        if "440" in app_entry_regex.findall(apps_block):
 
             #Build the path to the TF2 folder and check if it exists. If so, then we're done:
             tf2_folder = path_join(path, "steamapps", "common", "Team Fortress 2")
-            if isdir(tf2_folder) and isfile(tf2_folder + "/hl2_linux"):
+            if isdir_cached(tf2_folder) and isfile_cached(tf2_folder + "/hl2_linux"):
                 print(">>> Found TF2 directory:", tf2_folder)
                 return tf2_folder
 
@@ -158,106 +201,147 @@ def copy_asset_pack_files(tf2_dir: str):
     asset_pack_dir = getcwd() + sep + "tf"
     client_dir = tf2_dir + sep + "tf"
 
-    #Scan our /tf/ folder and calculate the file size and relative file paths of all the files that are in it:
-    copy_size = 0
-    files_to_copy = []
-    for x in walk(asset_pack_dir):
-        (current_dir, _, files_list) = x
-        rel_path = current_dir.replace(asset_pack_dir, "").strip(sep)
-
-        #Create the analogus directory in the client's TF2 folder:
-        makedirs(client_dir + sep + rel_path, exist_ok=True)
+    #Every scanned file path starts with our /tf/ folder, so work out the prefixes once instead of for every file:
+    asset_prefix_len = len(asset_pack_dir) + 1
+    client_prefix = client_dir + sep
+
+    #Scan our /tf/ folder and copy each file over to the client's game files as soon as we find it.
+    #The copies are independent of each other, so we hand them to a pool of worker threads to keep the disk busy while we carry on scanning.
+    #We only keep a few copies queued per worker, so the scan doesn't run far ahead of the copies and we never hold every pending file in memory at once.
+    #Since we don't know the total size until the scan is done, the progress is reported as the number of megabytes copied so far.
+    makedirs(client_dir, exist_ok=True)
+    client_dev = stat(client_dir).st_dev
+    max_workers = min(16, (cpu_count() or 1)*4)
+    max_pending = max_workers*4
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        try:
+            files = scan_asset_pack_dir(asset_pack_dir)
+            scanning = True
+            total_copied = 0
+            last_mb = -1
+            while scanning or pending:
+
+                #Top up the queue of copies with the next files from the scan:
+                while scanning and len(pending) < max_pending:
+                    x = next(files, None)
+                    if x is None:
+                        scanning = False
+                        break
+                    (file_path, file_stat) = x
+
+                    #The scan already gives us the full path, so the matching path in the client's TF2 folder is just the same path with the other /tf/ folder in front:
+                    dst_path = client_prefix + file_path[asset_prefix_len:]
+
+                    #Create the analogus directory in the client's TF2 folder.
+                    #The scan yields each directory before anything inside it, and this happens here on the main thread, so the workers never race each other on makedirs:
+                    if file_stat is None:
+                        makedirs(dst_path, exist_ok=True)
+                        continue
+
+                    #Queue the copy. We pass the whole stat result along so the copy doesn't need to stat the file again:
+                    future = executor.submit(copy_file, file_path, dst_path, file_stat, client_dev)       #Copy the file over
+                    pending[future] = (file_path, file_stat.st_size)
+                if not pending:
+                    continue
 
-        #Loop each file in this directory:
-        for file in sorted(files_list):         #Sort this list so that the progress printout isn't a random messy soup
+                #Wait for at least one copy to finish, then tally up the progress. This only happens on the main thread, so the counter needs no lock.
+                #Asset packs can contain thousands of tiny files, so we only print a progress line once per megabyte instead of once per file:
+                (done, _) = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (file_path, size) = pending.pop(future)
+                    future.result()         #Re-raise any error that occurred while copying this file
+                    total_copied += size
+                    copied_mb = total_copied//(1024*1024)
+                    if copied_mb != last_mb:
+                        print("[{} MB] Copied: {}".format(copied_mb, file_path[asset_prefix_len:]))
+                        last_mb = copied_mb
+
+        #If anything goes wrong (including the user pressing Ctrl-C), cancel the copies that haven't started yet instead of running them all before we stop.
+        #Leaving the with block still waits for the copies that are already running:
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+    print(">>> Total size of assets copied: {:.2f} MB".format(total_copied/1024/1024))
+    sys.stdout.flush()
+
+
+
+#Recursively scans a directory in our asset pack for files to copy.
+#The DirEntry objects from scandir already carry the information we need, so we don't have to stat each file a second time.
+
+#Clients do not need .nav or .pop files. If they want them, they can install those manually.
+#These files are included in the asset pack for community server operators to install on their servers.
+skipped_extensions = frozenset({".nav", ".pop"})
+
+def scan_asset_pack_dir(current_dir: str):
+    """Yields the path and stat result of every file in the given directory and its subdirectories, and the path and None for every subdirectory."""
+
+    #Loop each entry in this directory. The with block closes the directory handle even if the caller stops the scan early:
+    with scandir(current_dir) as entries:
+        for entry in entries:
+
+            #Report subdirectories (even empty ones) before descending into them:
+            if entry.is_dir(follow_symlinks=False):
+                yield (entry.path, None)
+                yield from scan_asset_pack_dir(entry.path)
+                continue
 
-            #Clients do not need .nav or .pop files. If they want them, they can install those manually.
-            #These files are included in the asset pack for community server operators to install on their servers.
-            if file.endswith((".nav", ".pop")):
+            #Skip anything that isn't a file:
+            if not entry.is_file():
                 continue
 
-            #Add the file size and the relative file paths to our list of files:
-            size = getsize(current_dir + sep + file)
-            copy_size += size
-            files_to_copy.append((rel_path + sep + file, size))
+            #Skip the file types that clients don't need:
+            (_, dot, extension) = entry.name.rpartition(".")
+            if dot and dot + extension in skipped_extensions:
+                continue
 
-    #Now copy each file over from our asset pack directory to the client's game files:
-    print(">>> Total size of assets to copy: {:.2f} MB".format(copy_size/1024/1024))
-    total_copied = 0
-    for x in files_to_copy:
-        (rel_file_path, size) = x
-        print("[{:.2f}%] Copying: {}".format(total_copied*100/copy_size, rel_file_path))
-        copy2(asset_pack_dir + sep + rel_file_path, client_dir + sep + rel_file_path)       #Copy the file over
-        total_copied += size
+            yield (entry.path, entry.stat())
 
 
 
-#############
+#Copies a single file from our asset pack to the client's game files.
+#Within the same filesystem, copy_file_range lets the kernel copy the data directly (or even share the blocks on filesystems such as btrfs and XFS), so the file contents never pass through Python.
+#Newer kernels refuse to use copy_file_range across filesystems, so there we reserve the space for the file up front and copy it with sendfile, which also stays in the kernel.
+#The source file's stat result comes from the scan, so we already know its size, permissions and timestamps without asking the kernel again.
+#dst_dev is the device ID of the filesystem that the destination file lives on.
 
-#KeyValues library taken from: https://github.com/gorgitko/valve-keyvalues-python
-#The library was minified to remove unused methods and functionality.
-
-class KeyValues(dict):
-    __re = __import__('re')
-    __OrderedDict = __import__('collections').OrderedDict
-    __regexs = {
-        "key": __re.compile(r"""(['"])(?P<key>((?!\1).)*)\1(?!.)""", __re.I),
-        "key_value": __re.compile(r"""(['"])(?P<key>((?!\1).)*)\1(\s+|)['"](?P<value>((?!\1).)*)\1""", __re.I)
-    }
-    
-    def __init__(self, mapper=None, filename=None, encoding="utf-8", mapper_type=__OrderedDict, key_modifier=None, key_sorter=None):
-        self.mapper_type = type(mapper) if mapper else mapper_type
-        self.key_modifier = key_modifier
-        self.key_sorter = key_sorter
-        self.parse(filename)
-
-    def __getitem__(self, key):
-        return self.__mapper[key]
-
-    def __key_modifier(self, key, key_modifier):
-        key_modifier = key_modifier or self.key_modifier
-        if key_modifier:
-            return key_modifier(key)
-        else:
-            return key
-
-    def __parse(self, lines, mapper_type, i=0, key_modifier=None):
-        key = False
-        _mapper = mapper_type()
+def copy_file(src: str, dst: str, src_stat: stat_result, dst_dev: int):
+    """Copies a file along with its permissions and timestamps. Unlike shutil.copy2, extended attributes are not copied."""
 
-        try:
-            while i < len(lines):
-                if lines[i].startswith("{"):
-                    if not key:
-                        raise Exception("'{{' found without key at line {}".format(i + 1))
-                    _mapper[key], i = self.__parse(lines, i=i+1, mapper_type=mapper_type, key_modifier=key_modifier)
-                    continue
-                elif lines[i].startswith("}"):
-                    return _mapper, i + 1
-                elif self.__re.match(self.__regexs["key"], lines[i]):
-                    key = self.__key_modifier(self.__re.search(self.__regexs["key"], lines[i]).group("key"), key_modifier)
-                    i += 1
-                    continue
-                elif self.__re.match(self.__regexs["key_value"], lines[i]):
-                    groups = self.__re.search(self.__regexs["key_value"], lines[i])
-                    _mapper[self.__key_modifier(groups.group("key"), key_modifier)] = groups.group("value")
-                    i += 1
-                elif self.__re.match(self.__regexs["key_value"], lines[i] + lines[i+1]):
-                    groups = self.__re.search(self.__regexs["key_value"], lines[i] + " " + lines[i+1])
-                    _mapper[self.__key_modifier(groups.group("key"), key_modifier)] = groups.group("value")
-                    i += 1
+    #Copy the file contents in the kernel. If these calls aren't available or the filesystems don't support them, fall back to shutil.copy2:
+    if copy_file_range is None:
+        copy2(src, dst)
+        return None
+    try:
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+
+            #When copying to another filesystem, reserve the space for the whole file up front so the filesystem can lay it out in as few extents as possible.
+            #Within the same filesystem, copy_file_range may share the source's blocks instead of writing new ones, and preallocated space would just be thrown away:
+            same_filesystem = src_stat.st_dev == dst_dev
+            if src_stat.st_size and not same_filesystem:
+                posix_fallocate(dst_file.fileno(), 0, src_stat.st_size)
+
+            remaining = src_stat.st_size
+            while remaining > 0:
+                if same_filesystem:
+                    copied = copy_file_range(src_file.fileno(), dst_file.fileno(), remaining)
                 else:
-                    i += 1
-        except IndexError:
-            pass
+                    copied = sendfile(dst_file.fileno(), src_file.fileno(), None, min(remaining, 1 << 22))       #Copy up to 4 MB at a time
+
+                #If the source file ended early, don't leave a short or zero-filled copy behind. Let shutil.copy2 copy it again from scratch:
+                if not copied:
+                    raise OSError("Copy stopped with {} bytes left to copy".format(remaining))
+                remaining -= copied
+    except OSError:
+        copy2(src, dst)
+        return None
 
-        return _mapper
+    #Copy the permissions and timestamps over as well:
+    chmod(dst, S_IMODE(src_stat.st_mode))
+    utime(dst, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
 
-    def parse(self, filename, encoding="utf-8", mapper_type=__OrderedDict, key_modifier=None):
-        with open(filename, mode="r", encoding=encoding) as f:
-            self.__mapper = self.__parse([line.strip() for line in f.readlines()],
-                                         mapper_type=mapper_type or self.mapper_type,
-                                         key_modifier=key_modifier or self.key_modifier)
 
 
 #############